@@ -10,10 +10,12 @@ Telegram 频道 / 群组 / 私聊 → 关键词过滤（或全量） → 邮件
 
 import asyncio
 import hashlib
+import json
 import os
 import smtplib
 import subprocess
 import sys
+import threading
 import time
 from email.mime.text import MIMEText
 from pathlib import Path
@@ -75,6 +77,13 @@ GROUPS_FILE   = BASE_DIR / "groups.txt"
 USERS_FILE    = BASE_DIR / "users.txt"
 KEYWORDS_FILE = BASE_DIR / "keywords.txt"
 
+CONFIG_FILES = {
+    "channels": CHANNELS_FILE,
+    "groups": GROUPS_FILE,
+    "users": USERS_FILE,
+    "keywords": KEYWORDS_FILE,
+}
+
 VENV_DIR      = BASE_DIR / "venv"
 REQUIREMENTS  = ["telethon", "python-dotenv"]
 
@@ -86,6 +95,18 @@ SMTP_USER = os.getenv("SMTP_USER")
 SMTP_PASS = os.getenv("SMTP_PASS")
 TO_EMAILS = os.getenv("TO_EMAILS", "").split(",") if os.getenv("TO_EMAILS") else []
 
+# 运行时诊断 - 事件循环延迟阈值（秒，0 表示关闭）及分析结果输出目录
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.5"))
+PROFILE_DIR = BASE_DIR / "profiles"
+
+# 本地管理接口 - Unix 域套接字路径（留空表示关闭）及配置文件轮询间隔（秒，0 表示关闭轮询）
+ADMIN_SOCKET = os.getenv("ADMIN_SOCKET", str(BASE_DIR / "monitor.sock"))
+CONFIG_POLL_INTERVAL = float(os.getenv("CONFIG_POLL_INTERVAL", "5"))
+
+# 实体解析限速 - 每秒 RPC 次数及允许的突发次数
+RESOLVE_RATE = float(os.getenv("RESOLVE_RATE", "2"))
+RESOLVE_BURST = int(os.getenv("RESOLVE_BURST", "10"))
+
 # --------------------------------------------------------------------------- #
 # 2. 虚拟环境管理
 # --------------------------------------------------------------------------- #
@@ -137,9 +158,13 @@ def file_hash(path: Path) -> str:
 
 
 class Config:
-    """自动监控配置文件变化，按需重新加载。"""
+    """自动监控配置文件变化，按需重新加载。
 
-    def __init__(self) -> None:
+    files 可覆盖部分配置文件路径（如 replay 时用候选的 keywords.txt），其余沿用 CONFIG_FILES。
+    """
+
+    def __init__(self, files=None) -> None:
+        self._files = {**CONFIG_FILES, **(files or {})}
         # 当前文件内容哈希，用于快速判断是否变动
         self._hashes = {
             "channels": "",
@@ -196,19 +221,19 @@ class Config:
     # --------- 公开 API ----------
     @property
     def channels(self):
-        return self._load_file(CHANNELS_FILE, "channels")
+        return self._load_file(self._files["channels"], "channels")
 
     @property
     def groups(self):
-        return self._load_file(GROUPS_FILE, "groups")
+        return self._load_file(self._files["groups"], "groups")
 
     @property
     def users(self):
-        return self._load_file(USERS_FILE, "users")
+        return self._load_file(self._files["users"], "users")
 
     @property
     def keywords(self):
-        kw = self._load_file(KEYWORDS_FILE, "keywords")
+        kw = self._load_file(self._files["keywords"], "keywords")
         monitor_all = len(kw) == 0
         return kw, monitor_all
 
@@ -217,6 +242,142 @@ class Config:
         """频道 + 群组 的完整列表 (可直接用作 chats= 参数)"""
         return self.channels + self.groups
 
+    @staticmethod
+    def _validate_item(key: str, value: str) -> None:
+        """检查一个待写入的条目，规则与 _load_file 的解析一致。"""
+        if "\n" in value or "\r" in value:
+            raise ValueError(f"条目不能包含换行: {value!r}")
+        value = value.strip()
+        if not value:
+            raise ValueError("条目不能为空")
+        if value.startswith("#"):
+            raise ValueError(f"条目不能以 # 开头（会被当作注释）: {value}")
+        if key in ("channels", "groups"):
+            value = value.lstrip("@")
+            if value.startswith("-"):
+                try:
+                    int(value)
+                except ValueError:
+                    raise ValueError(f"无效的 chat_id: {value}") from None
+
+    def update_items(self, key: str, add=(), remove=()) -> list:
+        """增删某个配置文件中的条目并写回（保留注释），返回实际变动的条目。
+
+        先写临时文件再 os.replace，读取方永远不会看到写了一半的文件。
+        新增条目须能被 _load_file 原样读回，否则抛出 ValueError，文件不做任何修改。
+        """
+        for v in add:
+            self._validate_item(key, v)
+
+        path = self._files[key]
+        if not path.exists():
+            path.touch()
+
+        def norm(value: str) -> str:
+            value = value.strip()
+            return value if key == "keywords" else value.lstrip("@")
+
+        lines = path.read_text(encoding="utf-8").splitlines()
+        existing = {norm(l) for l in lines if l.strip() and not l.startswith("#")}
+        to_remove = {norm(v) for v in remove}
+
+        kept = [l for l in lines if l.startswith("#") or not l.strip() or norm(l) not in to_remove]
+        changed = [v for v in remove if norm(v) in existing]
+        existing -= to_remove
+        for v in add:
+            if norm(v) not in existing:
+                kept.append(v.strip())
+                existing.add(norm(v))
+                changed.append(v)
+
+        if changed:
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_text("\n".join(kept) + "\n", encoding="utf-8")
+            os.replace(tmp, path)
+        return changed
+
+
+# 以下匹配 / 路由 / 去重逻辑由实时监听与离线回放共用
+
+def match_keywords(text: str, keywords, monitor_all: bool) -> list:
+    """返回 text 命中的关键词列表（不区分大小写）；全量模式下恒为空列表。"""
+    if monitor_all:
+        return []
+    lowered = text.lower()
+    return [k for k in keywords if k.lower() in lowered]
+
+
+def is_monitored_chat(chats, chat_id: int, chat_username) -> bool:
+    """chat_id / 用户名是否在频道+群组配置列表中。"""
+    for monitored_chat in chats:
+        if isinstance(monitored_chat, int) and monitored_chat == chat_id:
+            return True
+        elif isinstance(monitored_chat, str) and chat_username and monitored_chat == chat_username:
+            return True
+    return False
+
+
+def dedup_key(peer_id: int, message_id: int, when=None) -> str:
+    """消息去重标识：对端 id + 消息 id + 分钟（when 为时间戳，缺省为当前时间）。"""
+    return f"{peer_id}_{message_id}_{time.strftime('%Y%m%d%H%M', time.localtime(when))}"
+
+
+def remember_message(sent_messages: set, key: str, limit: int = 1000) -> bool:
+    """记录一条待转发消息；已记录过返回 False。缓存超过 limit 时丢弃一条旧记录。"""
+    if key in sent_messages:
+        return False
+    sent_messages.add(key)
+    if len(sent_messages) > limit:
+        sent_messages.pop()
+    return True
+
+
+class ChatMeta:
+    """聊天元数据（类型、显示名、id），同一聊天的所有告警共享一个实例。"""
+
+    __slots__ = ("kind", "name", "peer_id")
+
+    def __init__(self, kind: str, name: str, peer_id: int) -> None:
+        self.kind = kind        # 频道 / 群组 / 私聊
+        self.name = name
+        self.peer_id = peer_id
+
+
+class Alert:
+    """一条待投递的告警。
+
+    在事件处理器入口从 Telethon 事件中一次性提取，之后匹配、去重、投递都只传递它，
+    不再持有 event / chat 对象；邮件标题、正文和 MIME 在投递线程中才渲染。
+    """
+
+    __slots__ = ("chat", "message_id", "timestamp", "text", "keywords")
+
+    def __init__(self, chat: ChatMeta, message_id: int, timestamp: float, text: str, keywords=()) -> None:
+        self.chat = chat
+        self.message_id = message_id
+        self.timestamp = timestamp   # 消息发送时间（Unix 时间戳）
+        self.text = text
+        self.keywords = tuple(keywords)
+
+    @property
+    def dedup_id(self) -> str:
+        return dedup_key(self.chat.peer_id, self.message_id, self.timestamp)
+
+    @property
+    def subject(self) -> str:
+        return f"【Telegram{self.chat.kind}】{self.chat.name}"
+
+    def render_body(self) -> str:
+        label = "发送者" if self.chat.kind == "私聊" else self.chat.kind
+        lines = [
+            f"{label}: {self.chat.name}",
+            f"ID: {self.chat.peer_id}",
+            f"时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.timestamp))}",
+        ]
+        if self.keywords:
+            lines.append(f"关键词: {', '.join(self.keywords)}")
+        return "\n".join(lines) + f"\n\n内容:\n{self.text}"
+
 # --------------------------------------------------------------------------- #
 # 4. 邮件发送工具
 # --------------------------------------------------------------------------- #
@@ -328,8 +489,823 @@ def send_email(subject: str, body: str) -> None:
         import traceback
         traceback.print_exc()
 
+
+def send_alert(alert: Alert) -> None:
+    """渲染并发送一条告警（在投递线程中调用，MIME 在这里才构建）。"""
+    send_email(alert.subject, alert.render_body())
+
+# --------------------------------------------------------------------------- #
+# 5. 运行时诊断（事件循环延迟 & 采样分析）
+# --------------------------------------------------------------------------- #
+
+class LoopLagMonitor:
+    """事件循环延迟监控。
+
+    循环内定时打点并记录调度延迟；看门狗线程发现打点停滞超过阈值时，
+    抓取事件循环线程当前的堆栈，定位是谁阻塞了循环（send_email、file_hash 等）。
+    """
+
+    def __init__(self, threshold: float, interval: float = 0.1) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.max_lag = 0.0
+        self._loop = None
+        self._loop_thread_id = None
+        self._handle = None
+        self._last_beat = time.monotonic()
+        self._stall_reported = False
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self, loop) -> None:
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._handle = loop.call_later(self.interval, self._beat, self._last_beat + self.interval)
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._watchdog.start()
+        print(f"🩺 事件循环延迟监控已启动（阈值 {self.threshold * 1000:.0f}ms）")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def _beat(self, expected: float) -> None:
+        now = time.monotonic()
+        lag = now - expected
+        self._last_beat = now
+        self._stall_reported = False
+        self.max_lag = max(self.max_lag, lag)
+        if lag > self.threshold:
+            print(f"🐢 事件循环被阻塞 {lag * 1000:.0f}ms")
+        self._handle = self._loop.call_later(self.interval, self._beat, now + self.interval)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(min(self.interval, self.threshold / 2)):
+            stalled = time.monotonic() - self._last_beat - self.interval
+            if stalled <= self.threshold or self._stall_reported:
+                continue
+            self._stall_reported = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            import traceback
+            stack = "".join(traceback.format_stack(frame))
+            print(f"🐢 事件循环已阻塞 {stalled * 1000:.0f}ms，当前堆栈:\n{stack}")
+
+
+class SamplingProfiler:
+    """低开销采样分析器：后台线程定时抓取目标线程堆栈并计数。
+
+    结果以 collapsed stack 格式写入 PROFILE_DIR，可直接交给 flamegraph.pl / speedscope。
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: dict = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        print(f"🔬 采样分析已启动（间隔 {self.interval * 1000:.0f}ms）")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self, top: int = 15) -> Path:
+        self._stop.set()
+        self._thread.join()
+        PROFILE_DIR.mkdir(exist_ok=True)
+        out = PROFILE_DIR / f"samples-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        ranked = sorted(self.samples.items(), key=lambda kv: kv[1], reverse=True)
+        out.write_text("".join(f"{k} {v}\n" for k, v in ranked), encoding="utf-8")
+
+        total = sum(self.samples.values()) or 1
+        print(f"🔬 采样分析已停止，共 {total} 个样本，热点如下:")
+        for stack, count in ranked[:top]:
+            print(f"   {count * 100 / total:5.1f}%  {stack.rsplit(';', 1)[-1]}")
+        print(f"📄 完整结果已写入 {out}")
+        return out
+
+
+def install_diagnostics(loop):
+    """启动事件循环延迟监控，并注册 SIGUSR1 / SIGUSR2 分析开关。
+
+    - SIGUSR1：开始 / 停止采样分析（低开销，可长期开启）
+    - SIGUSR2：开始 / 停止 cProfile + tracemalloc，停止时输出统计并写入 PROFILE_DIR
+
+    返回 LoopLagMonitor（若已关闭则为 None），供退出时调用 stop()。
+    """
+    lag_monitor = None
+    if LOOP_LAG_THRESHOLD > 0:
+        lag_monitor = LoopLagMonitor(LOOP_LAG_THRESHOLD)
+        lag_monitor.start(loop)
+
+    import signal
+    if not hasattr(signal, "SIGUSR1"):
+        print("⚠️ 当前平台不支持 SIGUSR1/SIGUSR2，分析开关不可用")
+        return lag_monitor
+
+    sampler = SamplingProfiler(threading.get_ident())
+    state = {"profiler": None}
+
+    def toggle_sampler() -> None:
+        if sampler.running:
+            sampler.stop()
+        else:
+            sampler.start()
+
+    def toggle_cprofile() -> None:
+        import cProfile
+        import io
+        import pstats
+        import tracemalloc
+
+        if state["profiler"] is None:
+            state["profiler"] = cProfile.Profile()
+            state["profiler"].enable()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            print("🔬 cProfile + tracemalloc 已启动，再次发送 SIGUSR2 输出结果")
+            return
+
+        profiler, state["profiler"] = state["profiler"], None
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        PROFILE_DIR.mkdir(exist_ok=True)
+        out = PROFILE_DIR / f"cprofile-{time.strftime('%Y%m%d-%H%M%S')}.prof"
+        profiler.dump_stats(str(out))
+        buf = io.StringIO()
+        pstats.Stats(profiler, stream=buf).sort_stats("cumulative").print_stats(20)
+        print(buf.getvalue())
+        print(f"📄 cProfile 结果已写入 {out}")
+        print("🧠 内存分配热点（tracemalloc）:")
+        for stat in snapshot.statistics("lineno")[:10]:
+            print(f"   {stat}")
+
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, toggle_sampler)
+        loop.add_signal_handler(signal.SIGUSR2, toggle_cprofile)
+        print(f"🔬 分析开关已就绪: kill -USR1 {os.getpid()}（采样） / kill -USR2 {os.getpid()}（cProfile）")
+    except (NotImplementedError, RuntimeError) as e:
+        print(f"⚠️ 无法注册分析信号: {e}")
+    return lag_monitor
+
+# --------------------------------------------------------------------------- #
+# 6. 本地管理接口客户端
+# --------------------------------------------------------------------------- #
+
+ADMIN_USAGE = """用法: python3 monitor_and_email.py ctl <命令> [参数]
+
+命令:
+  stats                          查看队列深度、缓存大小、各聊天速率和最近错误
+  reload                         立即重新加载配置并重新注册监听器
+  pause / resume                 暂停 / 恢复邮件投递（暂停期间的告警排队，恢复后补发）
+  add <类型> <条目>...           添加条目并写回配置文件
+  remove <类型> <条目>...        删除条目并写回配置文件
+
+类型: channels | groups | users | keywords"""
+
+
+def admin_request(cmd: str, args=(), timeout: float = 10) -> dict:
+    """向运行中的监控进程发送一条管理命令，返回解析后的 JSON 响应。"""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(ADMIN_SOCKET)
+        sock.sendall(json.dumps({"cmd": cmd, "args": list(args)}, ensure_ascii=False).encode("utf-8") + b"\n")
+        buf = b""
+        while not buf.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buf += chunk
+    return json.loads(buf.decode("utf-8"))
+
+
+def admin_client(argv: list) -> int:
+    """`ctl` 子命令入口：发送命令并打印结果，返回进程退出码。"""
+    if not argv or argv[0] in ("-h", "--help", "help"):
+        print(ADMIN_USAGE)
+        return 0 if argv else 1
+    if not ADMIN_SOCKET:
+        print("管理接口已关闭（ADMIN_SOCKET 为空）")
+        return 1
+    try:
+        resp = admin_request(argv[0], argv[1:])
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"无法连接到 {ADMIN_SOCKET}，监控进程是否在运行？")
+        return 1
+    except OSError as e:
+        print(f"管理接口通信失败: {e}")
+        return 1
+
+    if not resp.get("ok"):
+        print(f"❌ {resp.get('error', '未知错误')}")
+        return 1
+    print(json.dumps(resp.get("result"), ensure_ascii=False, indent=2))
+    return 0
+
+# --------------------------------------------------------------------------- #
+# 7. 离线回放（replay）
+# --------------------------------------------------------------------------- #
+
+REPLAY_USAGE = """用法: python3 monitor_and_email.py replay <result.json | dump.jsonl> [选项]
+
+用当前配置（或 --keywords 等指定的候选文件）回放历史消息，统计会产生多少封邮件，不发送任何邮件。
+
+选项:
+  --keywords/--channels/--groups/--users FILE   用指定文件代替对应的配置文件
+  --peer-map FILE                              用户名 → id 对照表，每行 "用户名 id"（# 开头为注释）
+  --workers N                                  JSONL 按字节区间分给 N 个进程并行处理
+  --top N                                      每个排行榜显示前 N 项（默认 20）
+
+注意: Telegram Desktop 导出的 result.json 不含用户名。配置中按用户名填写的频道 / 群组 / 用户
+只能退而按聊天名称匹配，通常匹配不上，统计会偏少。请用 --peer-map 提供对应的 id
+（格式与 channels.txt 的数字 id 相同：频道 / 群组为 -100 开头，用户为正数）。
+
+JSONL 每行一条消息，字段:
+  chat_id（带 -100 前缀的 id）、chat_type（channel / group / private）、
+  chat_username、chat_title、id、date（Unix 时间戳或 ISO 时间）、text、out（是否自己发出）"""
+
+_EXPORT_CHAT_TYPES = {
+    "public_channel": "频道",
+    "private_channel": "频道",
+    "public_supergroup": "群组",
+    "private_supergroup": "群组",
+    "private_group": "群组",
+}
+
+
+class _JsonStream:
+    """按块读取 JSON 文本的游标，配合 raw_decode 逐个解析值，内存只保留当前块。"""
+
+    CHUNK = 1 << 20
+
+    def __init__(self, f) -> None:
+        self._f = f
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._f.read(self.CHUNK)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """跳过空白和逗号，返回下一个有意义的字符（文件结束返回空串）。"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\r\n,":
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def peek_more(self) -> str:
+        """同 peek()，但文件已结束时报错（用于还在等待后续内容的位置）。"""
+        c = self.peek()
+        if not c:
+            raise ValueError("JSON 意外结束")
+        return c
+
+    def take(self) -> str:
+        c = self.peek()
+        self._pos += 1
+        return c
+
+    def value(self):
+        """解析一个完整的值；值被块边界截断时继续读入再试。"""
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+                # 数字可能恰好在块末尾被截断，需确认其后还有字符
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            if not self._fill():
+                obj, self._pos = self._decoder.raw_decode(self._buf, self._pos)
+                return obj
+
+
+def _walk_export(stream: _JsonStream, meta: dict):
+    """遍历 Telegram Desktop 导出的 JSON，逐条产出 (所属聊天元数据, 消息)。
+
+    只有 "messages" 数组里的元素会被完整解析；聊天的 name/type/id 在导出中位于
+    messages 之前，因此遍历到消息时元数据已经就绪。
+    """
+    opener = stream.peek_more()
+    stream.take()
+    if opener == "{":
+        while stream.peek_more() != "}":
+            key = stream.value()
+            if stream.peek_more() != ":":
+                raise ValueError("JSON 格式错误：缺少 ':'")
+            stream.take()
+            nxt = stream.peek_more()
+            if key == "messages" and nxt == "[":
+                stream.take()
+                while stream.peek_more() != "]":
+                    yield meta, stream.value()
+                stream.take()
+            elif nxt in ("{", "["):
+                yield from _walk_export(stream, {})
+            else:
+                meta[key] = stream.value()
+        stream.take()
+    elif opener == "[":
+        while stream.peek_more() != "]":
+            if stream.peek_more() in ("{", "["):
+                yield from _walk_export(stream, {})
+            else:
+                stream.value()
+        stream.take()
+
+
+def _message_text(text) -> str:
+    """导出中的 text 可能是字符串，也可能是字符串 / 实体片段组成的列表。"""
+    if isinstance(text, str):
+        return text
+    return "".join(p if isinstance(p, str) else p.get("text", "") for p in text or [])
+
+
+def _message_time(msg: dict) -> float:
+    value = msg.get("date_unixtime", msg.get("date"))
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        from datetime import datetime
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+def iter_export_messages(path: Path):
+    """流式读取 result.json，产出 (聊天类型, peer_id, 用户名或名称, 消息 id, 时间戳, 文本, 是否自己发出)。"""
+    with path.open("r", encoding="utf-8") as f:
+        for meta, msg in _walk_export(_JsonStream(f), {}):
+            if not isinstance(msg, dict) or msg.get("type") != "message" or "id" not in meta:
+                continue
+            raw_id = int(meta["id"])
+            chat_type = meta.get("type", "")
+            kind = _EXPORT_CHAT_TYPES.get(chat_type, "私聊")
+            if chat_type == "private_group":
+                peer_id = -raw_id
+            elif kind != "私聊":
+                peer_id = int(f"-100{raw_id}")
+            else:
+                peer_id = raw_id
+            out = kind == "私聊" and msg.get("from_id") != f"user{raw_id}"
+            yield (kind, peer_id, meta.get("name") or str(raw_id), msg["id"],
+                   _message_time(msg), _message_text(msg.get("text")), out)
+
+
+def _jsonl_record(msg: dict):
+    kind = {"channel": "频道", "group": "群组"}.get(msg.get("chat_type"), "私聊")
+    name = msg.get("chat_username") or msg.get("chat_title") or str(msg.get("chat_id"))
+    return (kind, int(msg["chat_id"]), name, msg.get("id"),
+            _message_time(msg), _message_text(msg.get("text")), bool(msg.get("out")))
+
+
+def iter_jsonl_messages(path: Path, start: int = 0, end=None):
+    """逐行读取 JSONL；给定 [start, end) 时只处理起始位置落在区间内的行。"""
+    with path.open("rb") as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()   # 跳到区间内第一个完整行
+        pos = f.tell()
+        for line in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            if not line.strip():
+                continue
+            try:
+                yield _jsonl_record(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"⚠️ 跳过无法解析的行: {e}")
+
+
+class ReplayStats:
+    """回放统计，可跨进程合并。"""
+
+    def __init__(self) -> None:
+        from collections import Counter
+        self.messages = 0
+        self.emails = 0
+        self.duplicates = 0
+        self.per_keyword = Counter()
+        self.per_chat = Counter()
+        self.per_hour = Counter()
+        self.first_ts = None
+        self.last_ts = None
+
+    def merge(self, other: "ReplayStats") -> None:
+        self.messages += other.messages
+        self.emails += other.emails
+        self.duplicates += other.duplicates
+        self.per_keyword.update(other.per_keyword)
+        self.per_chat.update(other.per_chat)
+        self.per_hour.update(other.per_hour)
+        for ts in (other.first_ts, other.last_ts):
+            if ts is not None:
+                self.first_ts = ts if self.first_ts is None else min(self.first_ts, ts)
+                self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+
+    def report(self, top: int = 20) -> None:
+        print(f"📊 回放消息 {self.messages} 条，预计发送邮件 {self.emails} 封（去重跳过 {self.duplicates} 条）")
+        if self.first_ts is not None:
+            days = max((self.last_ts - self.first_ts) / 86400, 1 / 24)
+            print(f"🕒 时间范围: {time.strftime('%Y-%m-%d %H:%M', time.localtime(self.first_ts))}"
+                  f" ~ {time.strftime('%Y-%m-%d %H:%M', time.localtime(self.last_ts))}")
+            print(f"📬 平均每天 {self.emails / days:.1f} 封")
+        if self.per_hour:
+            hour, peak = self.per_hour.most_common(1)[0]
+            print(f"📈 峰值小时 {hour}:00，{peak} 封")
+        for title, counter in (("🔑 各关键词命中", self.per_keyword), ("💬 各聊天邮件数", self.per_chat)):
+            if counter:
+                print(f"{title}:")
+                for name, count in counter.most_common(top):
+                    print(f"   {count:8d}  {name}")
+
+
+def load_peer_map(path: Path) -> dict:
+    """读取 --peer-map 文件，返回 {小写用户名: id}。"""
+    peer_map = {}
+    for line in path.read_text(encoding="utf-8").splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith("#"):
+            continue
+        if len(parts) != 2 or not parts[1].lstrip("-").isdigit():
+            raise ValueError(f"无效的对照行（应为 \"用户名 id\"）: {line}")
+        peer_map[parts[0].lstrip("@").lower()] = int(parts[1])
+    return peer_map
+
+
+def _apply_peer_map(items, peer_map: dict) -> list:
+    """把配置中的用户名条目替换为对照表里的 id，其余条目原样保留。"""
+    result = []
+    for item in items:
+        if isinstance(item, str) and item.lstrip("@").lower() in peer_map:
+            item = peer_map[item.lstrip("@").lower()]
+        result.append(item)
+    return result
+
+
+def replay_records(records, chats, users, keywords, monitor_all) -> ReplayStats:
+    """把消息依次送入与实时监听相同的路由、匹配、去重逻辑，只计数不发送。"""
+    stats = ReplayStats()
+    sent_messages: set = set()
+    user_ids = {int(u) for u in users if str(u).lstrip("-").isdigit()}
+    user_names = {u.lstrip("@") for u in users if isinstance(u, str)}
+
+    for kind, peer_id, name, msg_id, ts, text, out in records:
+        if not text:
+            continue
+        if kind == "私聊":
+            if out or (peer_id not in user_ids and name not in user_names):
+                continue
+        elif not is_monitored_chat(chats, peer_id, name):
+            continue
+
+        stats.messages += 1
+        matched = match_keywords(text, keywords, monitor_all)
+        if not (monitor_all or matched):
+            continue
+        if not remember_message(sent_messages, dedup_key(peer_id, msg_id, ts)):
+            stats.duplicates += 1
+            continue
+
+        stats.emails += 1
+        stats.per_keyword.update(matched or ["（全量转发）"])
+        stats.per_chat[f"【{kind}】{name}"] += 1
+        stats.per_hour[time.strftime("%Y-%m-%d %H", time.localtime(ts))] += 1
+        stats.first_ts = ts if stats.first_ts is None else min(stats.first_ts, ts)
+        stats.last_ts = ts if stats.last_ts is None else max(stats.last_ts, ts)
+    return stats
+
+
+def _replay_jsonl_shard(args) -> ReplayStats:
+    path, start, end, snapshot = args
+    return replay_records(iter_jsonl_messages(path, start, end), *snapshot)
+
+
+def replay_main(argv: list) -> int:
+    """`replay` 子命令入口。"""
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="monitor_and_email.py replay", usage=REPLAY_USAGE, add_help=False)
+    parser.add_argument("source")
+    for key in CONFIG_FILES:
+        parser.add_argument(f"--{key}", type=Path)
+    parser.add_argument("--peer-map", type=Path)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--top", type=int, default=20)
+    if not argv or argv[0] in ("-h", "--help", "help"):
+        print(REPLAY_USAGE)
+        return 0 if argv else 1
+    opts = parser.parse_args(argv)
+
+    source = Path(opts.source)
+    if not source.exists():
+        print(f"❌ 文件不存在: {source}")
+        return 1
+
+    overrides = {key: getattr(opts, key) for key in CONFIG_FILES if getattr(opts, key)}
+    # 回放只读：缺失的配置文件直接报错，不像实时监听那样自动创建
+    # （尤其 keywords.txt 缺失会被当成全量转发，统计就失去意义）
+    for path in [*{**CONFIG_FILES, **overrides}.values(), opts.peer_map]:
+        if path and not path.exists():
+            print(f"❌ 文件不存在: {path}")
+            return 1
+    try:
+        peer_map = load_peer_map(opts.peer_map) if opts.peer_map else {}
+    except ValueError as e:
+        print(f"❌ {e}")
+        return 1
+
+    config = Config(overrides)
+    keywords, monitor_all = config.keywords
+    chats = _apply_peer_map(config.all_chats(), peer_map)
+    users = _apply_peer_map(config.users, peer_map)
+    snapshot = (chats, users, keywords, monitor_all)
+
+    is_jsonl = source.suffix.lower() in (".jsonl", ".ndjson")
+    if not is_jsonl:
+        # 导出文件没有用户名，这些条目只能按聊天名称匹配，大概率被漏算
+        for item in chats + users:
+            if isinstance(item, str) and not item.lstrip("-").isdigit():
+                print(f"⚠️ result.json 不含用户名，{item} 只能按聊天名称匹配，统计可能偏少（可用 --peer-map 指定 id）")
+    print(f"🔁 回放 {source.name}：频道/群组 {len(snapshot[0])} 个，私聊用户 {len(snapshot[1])} 个，"
+          f"{'全量转发' if monitor_all else f'关键词 {len(keywords)} 个'}")
+
+    started = time.time()
+    if is_jsonl and opts.workers > 1:
+        from multiprocessing import Pool
+
+        size = source.stat().st_size
+        step = size // opts.workers + 1
+        shards = [(source, i * step, min((i + 1) * step, size), snapshot) for i in range(opts.workers)]
+        stats = ReplayStats()
+        with Pool(opts.workers) as pool:
+            for part in pool.imap_unordered(_replay_jsonl_shard, shards):
+                stats.merge(part)
+        # 各进程独立去重，跨分片边界的重复消息可能被多计一次
+    else:
+        if opts.workers > 1:
+            print("⚠️ result.json 只能单进程顺序解析，已忽略 --workers")
+        records = iter_jsonl_messages(source) if is_jsonl else iter_export_messages(source)
+        try:
+            stats = replay_records(records, *snapshot)
+        except ValueError as e:
+            print(f"❌ 解析 {source.name} 失败（文件可能不完整）: {e}")
+            return 1
+
+    stats.report(opts.top)
+    print(f"⏱️ 用时 {time.time() - started:.1f} 秒（未发送任何邮件）")
+    return 0
+
+# --------------------------------------------------------------------------- #
+# 8. 实体解析（合并请求 & 限速 & FloodWait 退避）
+# --------------------------------------------------------------------------- #
+
+class TokenBucket:
+    """异步令牌桶：允许 burst 次突发，之后按 rate 次/秒放行。"""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"令牌桶参数无效: rate={rate}, burst={burst}")
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        # 先扣减再等待：令牌可为负数，表示排在前面的请求已预约的额度
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class EntityResolver:
+    """集中的 Telegram 实体解析器，所有 get_entity 调用都经由这里。
+
+    - 缓存：成功结果同时按原始标识和带前缀的 peer id 缓存；失败结果短期内不再重试
+    - 合并：同一标识的并发请求共享一个 in-flight Future（single-flight）
+    - 批量：数字 id 在 batch_window 内攒成一批，一次 get_entity(list) 解析
+    - 限速：所有 RPC 经过令牌桶；遇到 FloodWait 时记下解封时间，请求延后重试而不是报错
+    """
+
+    BATCH_SIZE = 100
+
+    def __init__(self, client, rate: float = RESOLVE_RATE, burst: int = RESOLVE_BURST,
+                 batch_window: float = 0.05, negative_ttl: float = 300) -> None:
+        self.client = client
+        self.cache: dict = {}
+        self.batch_window = batch_window
+        self.negative_ttl = negative_ttl
+        self.stats = {"rpc_calls": 0, "coalesced": 0, "flood_waits": 0}
+        self._failed: dict = {}     # 标识 -> 允许重试的时间
+        self._inflight: dict = {}   # 标识 -> Future
+        self._pending: dict = {}    # 等待批量解析的数字 id -> Future
+        self._tasks: set = set()    # 持有后台任务引用，防止被垃圾回收
+        self._flood_waiters: set = set()   # lookup() 的等待者，触发 FloodWait 时唤醒
+        self._bucket = TokenBucket(rate, burst)
+        self._resume_at = 0.0
+
+    @staticmethod
+    def normalize(identifier):
+        """统一标识格式：数字字符串转 int，用户名去掉 @。"""
+        if isinstance(identifier, str):
+            identifier = identifier.strip().lstrip("@")
+            if identifier.lstrip("-").isdigit():
+                return int(identifier)
+        return identifier
+
+    @staticmethod
+    def peer_id(entity) -> int:
+        """带类型前缀的 peer id（频道为 -100 开头），可直接用作 events.NewMessage(chats=...)。"""
+        from telethon import utils
+        return utils.get_peer_id(entity)
+
+    @property
+    def flood_wait_remaining(self) -> float:
+        return max(0.0, self._resume_at - time.monotonic())
+
+    async def resolve(self, identifier, retry_failed: bool = False):
+        """解析单个标识，失败返回 None。retry_failed 为 True 时忽略失败缓存重新请求。"""
+        key = self.normalize(identifier)
+        if key in self.cache:
+            return self.cache[key]
+        if not retry_failed and self._failed.get(key, 0) > time.monotonic():
+            return None
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.stats["coalesced"] += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight[key] = fut
+            if isinstance(key, int):
+                if not self._pending:
+                    self._spawn(self._flush_batch())
+                self._pending[key] = fut
+            else:
+                self._spawn(self._resolve_one(key))
+        # shield：某个调用方被取消时不影响共享同一 Future 的其它调用方
+        return await asyncio.shield(fut)
+
+    async def lookup(self, identifier, timeout: float = 5):
+        """供消息处理器使用的非阻塞查询：最多等待 timeout 秒，绝不陪 FloodWait 一起等。
+
+        命中缓存直接返回；FloodWait 期间或超时则立即返回 None，解析留在后台继续，
+        结果写入缓存供后续消息使用。
+        """
+        return (await self.lookup_many([identifier], timeout))[identifier]
+
+    async def lookup_many(self, identifiers, timeout: float, retry_failed: bool = False) -> dict:
+        """lookup() 的批量版本，返回 {原始标识: 实体或 None}，None 表示失败或仍在后台解析。"""
+        identifiers = list(identifiers)
+        tasks = {}
+        for i in identifiers:
+            key = self.normalize(i)
+            if key not in self.cache:
+                tasks[i] = self._spawn(self.resolve(key, retry_failed))
+
+        if tasks and self.flood_wait_remaining <= 0:
+            flooded = asyncio.get_running_loop().create_future()   # 等待期间触发 FloodWait 时立即放弃
+            self._flood_waiters.add(flooded)
+            try:
+                pending = set(tasks.values())
+                deadline = time.monotonic() + timeout
+                while pending and not flooded.done():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    _, pending = await asyncio.wait(
+                        pending | {flooded}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    pending.discard(flooded)
+            finally:
+                self._flood_waiters.discard(flooded)
+
+        result = {}
+        for i in identifiers:
+            task = tasks.get(i)
+            if task is None:
+                result[i] = self.cache.get(self.normalize(i))
+            else:
+                result[i] = task.result() if task.done() else None
+        return result
+
+    async def resolve_many(self, identifiers, retry_failed: bool = False) -> dict:
+        """并发解析多个标识（会等待 FloodWait 结束），返回 {原始标识: 实体或 None}。"""
+        identifiers = list(identifiers)
+        entities = await asyncio.gather(*(self.resolve(i, retry_failed) for i in identifiers))
+        return dict(zip(identifiers, entities))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _call(self, func, arg):
+        """限速执行一次 RPC；遇到 FloodWait 时等到解封后重试。"""
+        from telethon.errors import FloodWaitError
+
+        while True:
+            wait = self.flood_wait_remaining
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._bucket.acquire()
+            try:
+                self.stats["rpc_calls"] += 1
+                return await func(arg)
+            except FloodWaitError as e:
+                self.stats["flood_waits"] += 1
+                self._resume_at = max(self._resume_at, time.monotonic() + e.seconds)
+                for waiter in self._flood_waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+                print(f"⏳ 触发 FloodWait，实体解析暂停 {e.seconds} 秒")
+
+    def _finish(self, key, entity) -> None:
+        if entity is not None:
+            self._failed.pop(key, None)
+            self.cache[key] = entity
+            try:
+                self.cache[self.peer_id(entity)] = entity
+            except Exception:
+                pass
+        else:
+            self._failed[key] = time.monotonic() + self.negative_ttl
+        fut = self._inflight.pop(key, None)
+        if fut is not None and not fut.done():
+            fut.set_result(entity)
+
+    async def _resolve_one(self, key) -> None:
+        entity = None
+        try:
+            entity = await self._call(self.client.get_entity, key)
+        except Exception as exc:
+            print(f"⚠️ 无法获取实体 {key}: {exc}")
+        finally:
+            self._finish(key, entity)
+
+    async def _flush_batch(self) -> None:
+        await asyncio.sleep(self.batch_window)
+        keys, self._pending = list(self._pending), {}
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            chunk = keys[i:i + self.BATCH_SIZE]
+            if len(chunk) == 1:
+                await self._resolve_one(chunk[0])
+                continue
+            try:
+                entities = await self._call(self.client.get_entity, chunk)
+            except Exception:
+                # 批中任一 id 无法解析都会让整批失败，退回逐个解析
+                await asyncio.gather(*(self._resolve_one(key) for key in chunk))
+                continue
+            for key, entity in zip(chunk, entities):
+                self._finish(key, entity)
+
 # --------------------------------------------------------------------------- #
-# 5. 主程序（真正跑监听器）
+# 9. 主程序（真正跑监听器）
 # --------------------------------------------------------------------------- #
 
 def main() -> None:
@@ -358,6 +1334,18 @@ def main() -> None:
             print(f"   - {var}")
         print("\n请创建 .env 文件或设置系统环境变量")
         sys.exit(1)
+
+    invalid_vars = []
+    if RESOLVE_RATE <= 0:
+        invalid_vars.append("RESOLVE_RATE（须大于 0）")
+    if RESOLVE_BURST < 1:
+        invalid_vars.append("RESOLVE_BURST（须不小于 1）")
+
+    if invalid_vars:
+        print("环境变量取值无效:")
+        for var in invalid_vars:
+            print(f"   - {var}")
+        sys.exit(1)
         
     try:
         from telethon import TelegramClient, events
@@ -405,17 +1393,130 @@ def main() -> None:
 
     create_templates()
 
+    from collections import deque
+
     config = Config()
-    user_cache: dict = {}       # 本地缓存用户 id -> entity
     sent_messages: set = set()  # 防止重复发送邮件的缓存
     start_time = time.time()    # 记录启动时间，避免处理历史消息
+    launch_time = time.time()   # 进程启动时间（不随重载更新），用于计算速率
+    watched_hashes = {key: file_hash(path) for key, path in CONFIG_FILES.items()}
+    chat_stats: dict = {}       # 聊天名 -> [收到消息数, 已转发数]
+    recent_errors = deque(maxlen=20)   # 最近的错误 (时间, 描述)
+    pending_alerts = deque(maxlen=1000)  # 待投递的 Alert；有上限，队满时丢弃最早的并计数
+    alerts_ready = None         # asyncio.Event：有新告警或恢复投递时唤醒投递任务（在事件循环内创建）
+    chat_metas: dict = {}       # peer id -> ChatMeta，同一聊天的告警共享
+    delivery = {"paused": False, "dropped": 0, "sending": False}
+    lag_monitor = None
 
     client = TelegramClient(SESSION, API_ID, API_HASH)
+    resolver = EntityResolver(client)   # 所有实体查询的唯一入口（缓存 / 合并 / 限速）
+    watched_users = {"ids": set(), "names": set()}   # 私聊关注对象，重载时解析一次
+    retry_state = {"task": None}   # 后台重试未解析条目的任务
+
+    # --------- 投递 & 统计 ----------
+    def record_error(context: str) -> None:
+        """打印当前异常堆栈，并记入最近错误列表供管理接口查看。"""
+        print(f"❌ {context}:")
+        traceback.print_exc()
+        exc = sys.exc_info()[1]
+        recent_errors.append((time.strftime('%Y-%m-%d %H:%M:%S'), f"{context}: {exc!r}"))
+
+    def count_message(chat_name: str, forwarded: bool) -> None:
+        counts = chat_stats.setdefault(chat_name, [0, 0])
+        counts[0] += 1
+        if forwarded:
+            counts[1] += 1
+
+    def chat_meta_for(peer_id: int, kind: str, name: str) -> ChatMeta:
+        meta = chat_metas.get(peer_id)
+        if meta is None or meta.kind != kind or meta.name != name:
+            meta = chat_metas[peer_id] = ChatMeta(kind, name, peer_id)
+        return meta
+
+    def deliver(alert: Alert) -> None:
+        """告警入队，由 delivery_worker 发送；暂停期间保留在队列中，恢复后补发。
+
+        队列有上限以保证内存可控；队满时丢弃最早的一条，并记录日志与丢弃计数。
+        """
+        if len(pending_alerts) == pending_alerts.maxlen:
+            dropped = pending_alerts[0]
+            delivery["dropped"] += 1
+            note = (f"待投递队列已满（{pending_alerts.maxlen} 条），丢弃最早的告警: "
+                    f"{dropped.subject} (消息 {dropped.message_id})，累计丢弃 {delivery['dropped']} 条")
+            print(f"⚠️ {note}")
+            recent_errors.append((time.strftime('%Y-%m-%d %H:%M:%S'), note))
+        pending_alerts.append(alert)
+        if delivery["paused"]:
+            print(f"⏸️ 投递已暂停，告警入队（队列 {len(pending_alerts)}）: {alert.subject}")
+        else:
+            print(f"📬 发送邮件: {alert.subject} (消息 {alert.message_id})")
+        alerts_ready.set()
+
+    async def delivery_worker() -> None:
+        """逐封发送排队的告警；SMTP 是同步调用，放到线程池执行以免阻塞事件循环。"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await alerts_ready.wait()
+            while pending_alerts and not delivery["paused"]:
+                alert = pending_alerts.popleft()
+                delivery["sending"] = True
+                try:
+                    await loop.run_in_executor(None, send_alert, alert)
+                except Exception:
+                    record_error("发送告警邮件时错误")
+                finally:
+                    delivery["sending"] = False
+            alerts_ready.clear()
+
+    async def drain_alerts(timeout: float = 60) -> None:
+        """退出前尽量发完队列中的告警；暂停中或超时则报告未发送的数量。"""
+        if not delivery["paused"] and (pending_alerts or delivery["sending"]):
+            print(f"📤 退出前补发队列中的 {len(pending_alerts)} 条告警（最多等待 {timeout:g} 秒）...")
+            deadline = time.monotonic() + timeout
+            while (pending_alerts or delivery["sending"]) and time.monotonic() < deadline:
+                await asyncio.sleep(0.2)
+        if pending_alerts:
+            print(f"⚠️ 退出时仍有 {len(pending_alerts)} 条告警未发送，已丢弃")
 
     # --------- 监听器注册/更新 ----------
+    async def retry_unresolved(items: list) -> None:
+        """后台重试上次重载未能解析的条目；有新的解析成功就重新注册监听器。"""
+        for delay in (30, 120, 600):
+            await asyncio.sleep(delay)
+            resolved = await resolver.resolve_many(items, retry_failed=True)   # 后台任务，可等待 FloodWait
+            if any(e is not None for e in resolved.values()):
+                print(f"🔁 已补充解析 {[i for i, e in resolved.items() if e is not None]}，重新注册监听器")
+                schedule_reload()
+                return
+        print(f"⚠️ 多次重试后仍无法解析: {items}，将在下次配置变化时再试")
+
     async def reload_all_handlers() -> None:
         """在任何配置变化时，重新注册所有 NewMessage 处理器。"""
         nonlocal sent_messages, start_time  # 确保可以访问外部变量
+
+        # 以本次重载读到的文件为准，避免解析期间轮询再次触发同一变化
+        watched_hashes.update({key: file_hash(path) for key, path in CONFIG_FILES.items()})
+
+        # 先解析实体再清理旧处理器：解析期间旧处理器继续工作。最多等 10 秒，遇到 FloodWait
+        # 立即放弃等待，先用已解析的部分注册，其余交给 retry_unresolved 在后台补上。
+        # 重载时忽略失败缓存，避免一次偶发错误让某个聊天长时间不被监听。
+        # 注册时传入带前缀的 peer id，Telethon 不会再逐个重新解析。
+        chats = config.all_chats()
+        users = config.users
+        resolved = await resolver.lookup_many(chats + users, timeout=10, retry_failed=True)
+        chat_ids = [resolver.peer_id(resolved[c]) for c in chats if resolved[c] is not None]
+        unresolved = [i for i, e in resolved.items() if e is None]
+        if retry_state["task"] is not None:
+            retry_state["task"].cancel()
+            retry_state["task"] = None
+        if unresolved:
+            print(f"⚠️ 以下频道/群组/用户暂时无法解析，先行跳过并在后台重试: {unresolved}")
+            retry_state["task"] = asyncio.create_task(retry_unresolved(unresolved))
+        watched_users["ids"] = {resolved[u].id for u in users if resolved[u] is not None}
+        # 用户名直接与发送者比对，解析失败（例如 FloodWait 中）时仍能匹配
+        watched_users["names"] = {
+            str(u).lstrip("@").lower() for u in users if not str(u).lstrip("-").isdigit()
+        }
         
         print("🧹 正在清理所有旧的事件处理器...")
         
@@ -480,22 +1581,25 @@ def main() -> None:
         
         # 清理消息去重缓存
         sent_messages.clear()
+        chat_metas.clear()
         print("🧹 清理消息缓存")
 
         # 频道 / 群组监听
-        chats = config.all_chats()
-        if chats:
+        if chat_ids:
             print(f"📺 重新注册频道/群组监听: {chats}")
             
             # 直接注册处理器，避免函数嵌套问题
-            @client.on(events.NewMessage(chats=chats))
+            @client.on(events.NewMessage(chats=chat_ids))
             async def channel_group_handler(event):
                 try:
                     # 忽略启动前30秒的消息（避免处理历史消息）
                     if event.message.date.timestamp() < start_time - 30:
                         return
                         
-                    chat = await event.get_chat()
+                    # 优先使用更新中自带的实体，缺失时才经解析器查询
+                    chat = event.chat or await resolver.lookup(event.chat_id)
+                    if chat is None:
+                        return
                     msg_text = event.message.message
                     if not msg_text:
                         return
@@ -505,19 +1609,10 @@ def main() -> None:
                     current_chats = config.all_chats()
                     
                     # 双重检查：确保当前聊天仍在配置列表中
-                    chat_id = chat.id
+                    chat_id = event.chat_id
                     chat_username = getattr(chat, "username", None)
                     
-                    is_still_monitored = False
-                    for monitored_chat in current_chats:
-                        if isinstance(monitored_chat, int) and monitored_chat == chat_id:
-                            is_still_monitored = True
-                            break
-                        elif isinstance(monitored_chat, str) and chat_username and monitored_chat == chat_username:
-                            is_still_monitored = True
-                            break
-                    
-                    if not is_still_monitored:
+                    if not is_monitored_chat(current_chats, chat_id, chat_username):
                         print(f"⏭️ 忽略已移除频道 {chat_username or chat_id} 的消息")
                         return
 
@@ -531,37 +1626,33 @@ def main() -> None:
                     chat_name = chat_username or getattr(chat, "title", str(chat.id))
 
                     # 判断是否需要转发
-                    if monitor_all or any(k.lower() in msg_text.lower() for k in current_keywords):
-                        # 创建消息唯一标识符防重复发送
-                        msg_id = f"{chat.id}_{event.message.id}_{time.strftime('%Y%m%d%H%M')}"
-                        if msg_id in sent_messages:
-                            print(f"⏭️ 跳过重复消息: {msg_id}")
-                            return
-                        
-                        sent_messages.add(msg_id)
-                        # 限制缓存大小，保留最近1000条
-                        if len(sent_messages) > 1000:
-                            sent_messages.pop()
-                        
-                        print(f"📬 发送邮件: 【Telegram{chat_type}】{chat_name} (消息时间: {event.message.date})")
-                        subject = f"【Telegram{chat_type}】{chat_name}"
-                        body = (
-                            f"{chat_type}: {chat_name}\n"
-                            f"ID: {chat.id}\n"
-                            f"时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                            f"内容:\n{msg_text}"
+                    matched = match_keywords(msg_text, current_keywords, monitor_all)
+                    forward = monitor_all or bool(matched)
+                    count_message(chat_name, forward)
+                    if forward:
+                        # 只为需要转发的消息一次性提取告警记录，之后不再引用 event / chat
+                        alert = Alert(
+                            chat_meta_for(event.chat_id, chat_type, chat_name),   # 带前缀的 id，与配置 / 回放一致
+                            event.message.id,
+                            event.message.date.timestamp(),
+                            msg_text,
+                            matched,
                         )
-                        send_email(subject, body)
+                        # 消息唯一标识符防重复发送
+                        if not remember_message(sent_messages, alert.dedup_id):
+                            print(f"⏭️ 跳过重复消息: {alert.dedup_id}")
+                            return
+                        deliver(alert)
                 except Exception:
-                    print("❌ 处理频道/群组消息时错误:")
-                    traceback.print_exc()
+                    record_error("处理频道/群组消息时错误")
+        elif chats:
+            print("📺 频道/群组均未解析成功，暂不监听，等待后台重试")
         else:
             print("📺 未配置频道/群组监听")
 
         # 私聊监听
-        users_count = len(config.users)
-        if users_count > 0:
-            print(f"👤 重新注册私聊监听: {config.users}")
+        if users:
+            print(f"👤 重新注册私聊监听: {users}")
             
             # 直接注册私聊处理器
             @client.on(events.NewMessage(incoming=True))
@@ -573,7 +1664,6 @@ def main() -> None:
                         
                     if not event.is_private:
                         return
-                    sender = await event.get_sender()
                     msg_text = event.message.message
                     if not msg_text:
                         return
@@ -583,46 +1673,41 @@ def main() -> None:
                     if not current_users:  # 如果没有配置用户，直接返回
                         return
 
-                    # 判断发送者是否在关注列表
-                    matched = False
-                    for uid in current_users:
-                        target = await get_user_entity(uid)
-                        if target and target.id == sender.id:
-                            matched = True
-                            break
-                    if not matched:
+                    # 判断发送者是否在关注列表（id 集合在重载时已解析好，无需 RPC）
+                    sender = event.sender
+                    sender_username = (getattr(sender, "username", None) or "").lower()
+                    if event.sender_id not in watched_users["ids"] and sender_username not in watched_users["names"]:
                         return
+                    if sender is None:
+                        sender = await resolver.lookup(event.sender_id)
+                        if sender is None:
+                            return
 
                     current_keywords, monitor_all = config.keywords
-                    if monitor_all or any(k.lower() in msg_text.lower() for k in current_keywords):
-                        # 创建消息唯一标识符防重复发送
-                        msg_id = f"{sender.id}_{event.message.id}_{time.strftime('%Y%m%d%H%M')}"
-                        if msg_id in sent_messages:
-                            print(f"⏭️ 跳过重复私聊消息: {msg_id}")
-                            return
-                        
-                        sent_messages.add(msg_id)
-                        # 限制缓存大小，保留最近1000条
-                        if len(sent_messages) > 1000:
-                            sent_messages.pop()
-                        
+                    matched = match_keywords(msg_text, current_keywords, monitor_all)
+                    forward = monitor_all or bool(matched)
+                    count_message(f"私聊:{getattr(sender, 'username', None) or sender.id}", forward)
+                    if forward:
                         sender_name = (
                             getattr(sender, "username", None)
                             or f"{getattr(sender, 'first_name', '')} {getattr(sender, 'last_name', '')}".strip()
                         ).strip() or f"ID:{sender.id}"
-                        
-                        print(f"📬 发送邮件: 【Telegram私聊】{sender_name} (消息时间: {event.message.date})")
-                        subject = f"【Telegram私聊】{sender_name}"
-                        body = (
-                            f"发送者: {sender_name}\n"
-                            f"ID: {sender.id}\n"
-                            f"时间: {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-                            f"内容:\n{msg_text}"
+
+                        # 只为需要转发的消息一次性提取告警记录，之后不再引用 event / sender
+                        alert = Alert(
+                            chat_meta_for(sender.id, "私聊", sender_name),
+                            event.message.id,
+                            event.message.date.timestamp(),
+                            msg_text,
+                            matched,
                         )
-                        send_email(subject, body)
+                        # 消息唯一标识符防重复发送
+                        if not remember_message(sent_messages, alert.dedup_id):
+                            print(f"⏭️ 跳过重复私聊消息: {alert.dedup_id}")
+                            return
+                        deliver(alert)
                 except Exception:
-                    print("❌ 处理私聊消息时错误:")
-                    traceback.print_exc()
+                    record_error("处理私聊消息时错误")
         else:
             print("👤 未配置私聊用户监听")
         
@@ -630,65 +1715,168 @@ def main() -> None:
 
     # --------- 监控配置 ----------
     async def monitor_config() -> None:
-        """每 5 秒检查一次四个配置文件，变动即刷新监听器。"""
+        """每 CONFIG_POLL_INTERVAL 秒检查一次四个配置文件，变动即刷新监听器。"""
         # 初始化时等待一小段时间，避免启动时的文件操作干扰
         await asyncio.sleep(2)
         
-        last_hashes = {
-            "channels": file_hash(CHANNELS_FILE),
-            "groups": file_hash(GROUPS_FILE),
-            "users": file_hash(USERS_FILE),
-            "keywords": file_hash(KEYWORDS_FILE),
-        }
-        
-        print(f"📋 开始监控配置文件变化...")
+        print(f"📋 开始监控配置文件变化（每 {CONFIG_POLL_INTERVAL:g} 秒）...")
 
         while True:
             try:
-                await asyncio.sleep(5)   # 每5秒检查一次
+                await asyncio.sleep(CONFIG_POLL_INTERVAL)
                 
                 changed = False
                 changed_files = []
-                for key, path in [
-                    ("channels", CHANNELS_FILE),
-                    ("groups", GROUPS_FILE),
-                    ("users", USERS_FILE),
-                    ("keywords", KEYWORDS_FILE),
-                ]:
+                for key, path in CONFIG_FILES.items():
                     h = file_hash(path)
-                    if h != last_hashes[key]:
+                    if h != watched_hashes[key]:
                         changed = True
                         changed_files.append(path.name)
-                        last_hashes[key] = h
+                        watched_hashes[key] = h
 
                 if changed:
                     print(f"🔄 配置文件 {', '.join(changed_files)} 发生变化，重新注册监听器…")
-                    await reload_all_handlers()
+                    async with config_lock:
+                        await reload_all_handlers()
             except Exception:
                 print("❌ 监控配置时异常:")
                 traceback.print_exc()
 
-    # --------- 用户实体缓存 ----------
-    async def get_user_entity(user_identifier):
-        """返回用户实体，支持 int、@username、姓名等。"""
-        if user_identifier in user_cache:
-            return user_cache[user_identifier]
+    # --------- 本地管理接口 ----------
+    config_lock = None   # asyncio.Lock：串行化配置重载（在事件循环内创建）
+    reload_tasks: set = set()   # 管理命令触发的后台重载任务
+
+    def admin_stats() -> dict:
+        uptime = max(time.time() - launch_time, 1)
+        kw, monitor_all = config.keywords
+        return {
+            "uptime_seconds": round(uptime),
+            "paused": delivery["paused"],
+            "queue_depth": len(pending_alerts),
+            "dropped_alerts": delivery["dropped"],
+            "reloads_pending": len(reload_tasks),
+            "caches": {
+                "entity_cache": len(resolver.cache),
+                "sent_messages": len(sent_messages),
+            },
+            "config": {
+                "channels": len(config.channels),
+                "groups": len(config.groups),
+                "users": len(config.users),
+                "keywords": "全量转发" if monitor_all else len(kw),
+            },
+            "chats": {
+                name: {
+                    "messages": seen,
+                    "forwarded": forwarded,
+                    "per_minute": round(seen * 60 / uptime, 2),
+                }
+                for name, (seen, forwarded) in sorted(chat_stats.items(), key=lambda kv: -kv[1][0])
+            },
+            "resolver": {
+                **resolver.stats,
+                "flood_wait_remaining": round(resolver.flood_wait_remaining),
+            },
+            "loop_max_lag_ms": round(lag_monitor.max_lag * 1000) if lag_monitor else None,
+            "last_errors": [f"{ts} {msg}" for ts, msg in recent_errors],
+        }
+
+    async def background_reload() -> None:
         try:
-            # 修复：处理不同类型的用户标识符
-            if isinstance(user_identifier, str) and user_identifier.isdigit():
-                user_identifier = int(user_identifier)
-            elif isinstance(user_identifier, str) and user_identifier.startswith("@"):
-                user_identifier = user_identifier[1:]
-            
-            entity = await client.get_entity(user_identifier)
-            user_cache[user_identifier] = entity
-            return entity
-        except Exception as exc:
-            print(f"⚠️ 无法获取用户 {user_identifier}: {exc}")
+            async with config_lock:
+                await reload_all_handlers()
+        except Exception:
+            record_error("重新加载配置时错误")
+
+    def schedule_reload() -> None:
+        """在后台重载：实体解析可能因限速 / FloodWait 耗时很久，管理命令不等它完成。"""
+        task = asyncio.create_task(background_reload())
+        reload_tasks.add(task)
+        task.add_done_callback(reload_tasks.discard)
+
+    async def admin_command(cmd: str, args: list):
+        if cmd == "stats":
+            return admin_stats()
+        if cmd == "reload":
+            schedule_reload()
+            return "已开始后台重新加载，进度见日志或 ctl stats"
+        if cmd == "pause":
+            delivery["paused"] = True
+            return "投递已暂停"
+        if cmd == "resume":
+            delivery["paused"] = False
+            queued = len(pending_alerts)
+            alerts_ready.set()
+            return f"投递已恢复，补发 {queued} 条排队告警"
+        if cmd in ("add", "remove"):
+            if len(args) < 2 or args[0] not in CONFIG_FILES:
+                raise ValueError(f"用法: {cmd} <{'|'.join(CONFIG_FILES)}> <条目>...")
+            key, items = args[0], args[1:]
+            if cmd == "add":
+                changed = config.update_items(key, add=items)
+            else:
+                changed = config.update_items(key, remove=items)
+            if changed:
+                schedule_reload()
+            return {"file": CONFIG_FILES[key].name, "changed": changed, "reloading": bool(changed)}
+        raise ValueError(f"未知命令: {cmd}")
+
+    async def handle_admin(reader, writer) -> None:
+        try:
+            line = await reader.readline()
+            request = json.loads(line.decode("utf-8"))
+            try:
+                result = await admin_command(request.get("cmd", ""), list(request.get("args", [])))
+                response = {"ok": True, "result": result}
+            except ValueError as e:
+                response = {"ok": False, "error": str(e)}
+            except Exception as e:
+                record_error(f"执行管理命令 {request.get('cmd')} 时错误")
+                response = {"ok": False, "error": repr(e)}
+            writer.write(json.dumps(response, ensure_ascii=False).encode("utf-8") + b"\n")
+            await writer.drain()
+        except Exception:
+            record_error("处理管理连接时错误")
+        finally:
+            writer.close()
+
+    async def start_admin_server():
+        """在 ADMIN_SOCKET 上启动管理接口（仅当前用户可访问），失败时返回 None。"""
+        if not ADMIN_SOCKET:
+            return None
+        sock_path = Path(ADMIN_SOCKET)
+        try:
+            if sock_path.exists() or sock_path.is_symlink():
+                import socket
+                import stat
+                if not stat.S_ISSOCK(sock_path.lstat().st_mode):
+                    print(f"⚠️ {sock_path} 已存在且不是套接字，本实例不启动管理接口（请检查 ADMIN_SOCKET）")
+                    return None
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                    try:
+                        probe.connect(str(sock_path))
+                    except ConnectionRefusedError:
+                        sock_path.unlink()   # 无人监听：上次异常退出残留的套接字
+                    else:
+                        print(f"⚠️ {sock_path} 已被另一个运行中的实例占用，本实例不启动管理接口")
+                        return None
+            # 套接字在 bind 时即以 0600 权限创建，不留其它用户可连接的时间窗口
+            old_umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(handle_admin, path=str(sock_path))
+            finally:
+                os.umask(old_umask)
+        except (AttributeError, NotImplementedError, OSError) as e:
+            print(f"⚠️ 无法启动管理接口: {e}")
             return None
+        print(f"🛠️ 管理接口已启动: {sock_path}（python3 monitor_and_email.py ctl help）")
+        return server
 
     # --------- 主循环 ----------
     async def main_loop() -> None:
+        nonlocal lag_monitor, config_lock, alerts_ready
+        config_lock = asyncio.Lock()
+        alerts_ready = asyncio.Event()
         try:
             await client.start()
             print("✅ 已连接到 Telegram")
@@ -696,18 +1884,39 @@ def main() -> None:
             print(f"❌ 连接 Telegram 失败: {e}")
             return
 
+        # 诊断、管理接口和投递任务不依赖实体解析，先于初始注册启动
+        lag_monitor = install_diagnostics(asyncio.get_running_loop())
+        admin_server = await start_admin_server()
+        delivery_task = asyncio.create_task(delivery_worker())
+
         await reload_all_handlers()          # 初始注册
-        config_task = asyncio.create_task(monitor_config())
+        config_task = None
+        if CONFIG_POLL_INTERVAL > 0:
+            config_task = asyncio.create_task(monitor_config())
 
         print("✅ Telegram 监听已启动！")
         try:
             await client.run_until_disconnected()
         finally:
-            config_task.cancel()
+            if retry_state["task"] is not None:
+                retry_state["task"].cancel()
+            await drain_alerts()
+            delivery_task.cancel()
             try:
-                await config_task
+                await delivery_task
             except asyncio.CancelledError:
                 pass
+            if admin_server:
+                admin_server.close()
+                Path(ADMIN_SOCKET).unlink(missing_ok=True)
+            if lag_monitor:
+                lag_monitor.stop()
+            if config_task:
+                config_task.cancel()
+                try:
+                    await config_task
+                except asyncio.CancelledError:
+                    pass
 
     # 修复：使用正确的异步运行方式
     async def run_async():
@@ -717,13 +1926,19 @@ def main() -> None:
     asyncio.run(run_async())
 
 # --------------------------------------------------------------------------- #
-# 6. CLI 入口
+# 10. CLI 入口
 # --------------------------------------------------------------------------- #
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "run":
         # 已经在 venv 环境下启动 → 直接跑主程序
         main()
+    elif len(sys.argv) > 1 and sys.argv[1] == "ctl":
+        # 管理接口客户端（仅用标准库，无需 venv）
+        sys.exit(admin_client(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "replay":
+        # 离线回放（仅用标准库，无需 venv）
+        sys.exit(replay_main(sys.argv[2:]))
     elif len(sys.argv) > 1 and sys.argv[1] == "test":
         # 测试邮件配置
         create_virtualenv()